@@ -1,13 +1,67 @@
+import atexit
+import base64
+import collections
+import functools
+import hmac
+import html
+import logging
 import os
+import queue
 import secrets
-import json
+import threading
 import time
-from urllib.parse import urlencode
-from flask import Flask, redirect, request, session, jsonify, render_template_string
-
+import weakref
+from datetime import timedelta
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlencode, quote_plus
+from flask import Flask, g, redirect, request, session, jsonify
+from flask.json.provider import JSONProvider
+from flask.logging import default_handler
+
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# Local dev reads credentials from .env; deployed envs (Render) already export
+# them, so skip importing and parsing dotenv there
+if not os.getenv("TIKTOK_CLIENT_KEY"):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (used by jsonify and the session cookie)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson already produces UTF-8 bytes; skip the str decode/re-encode round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# ====== LOGGING ======
+# Request threads only enqueue records; a background listener writes them to stderr
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(default_handler.formatter)
+_log_listener = QueueListener(_log_queue, _log_handler, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(QueueHandler(_log_queue))
+app.logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+log = app.logger
 
 # ====== ENV ======
 # .env (or Render "Environment") MUST contain these, exactly:
@@ -16,7 +70,11 @@ app = Flask(__name__)
 # REDIRECT_URI=https://tiktok-upload.onrender.com/callback
 # FLASK_SECRET_KEY=<any random string>
 
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev_" + secrets.token_hex(16))
+# The random dev fallback is only generated when no key is configured
+app.secret_key = os.getenv("FLASK_SECRET_KEY") or ("dev_" + secrets.token_hex(16))
+
+# TikTok access tokens live for 24h; let the login session expire with them
+app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(hours=24)
 
 CLIENT_KEY = os.getenv("TIKTOK_CLIENT_KEY", "").strip()
 CLIENT_SECRET = os.getenv("TIKTOK_CLIENT_SECRET", "").strip()
@@ -32,9 +90,91 @@ CONTENT_INIT_URL = "https://open.tiktokapis.com/v2/post/publish/inbox/video/init
 
 SCOPES = "user.info.basic,video.upload,video.publish"
 
+# Everything in the authorize URL except `state` is fixed at startup, so encode it once
+AUTH_URL_PREFIX = AUTH_URL + "?" + urlencode({
+    "client_key": CLIENT_KEY,
+    "response_type": "code",
+    "scope": SCOPES,
+    "redirect_uri": REDIRECT_URI,   # <-- EXACT SAME STRING
+    # "force_verify": "1",  # optional: forces TikTok to re-prompt
+}) + "&state="
+
+# Same idea for the token exchange body: only `code` changes per login
+TOKEN_BODY_PREFIX = urlencode({
+    "client_key": CLIENT_KEY,
+    "client_secret": CLIENT_SECRET,
+    "grant_type": "authorization_code",
+    # *** MUST MATCH *** the value used in /login and the app portal
+    "redirect_uri": REDIRECT_URI,
+}) + "&code="
+
+# ...and for refreshing an access token: only `refresh_token` changes
+REFRESH_BODY_PREFIX = urlencode({
+    "client_key": CLIENT_KEY,
+    "client_secret": CLIENT_SECRET,
+    "grant_type": "refresh_token",
+}) + "&refresh_token="
+
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+JSON_HEADERS = {"Content-Type": "application/json; charset=UTF-8"}
+
+# Refresh the access token this many seconds before it actually expires,
+# so an upload never starts with a token that dies halfway through
+TOKEN_REFRESH_MARGIN = 5 * 60
+
+# Shaved off TikTok's expires_in to cover the token request's own latency and clock skew
+TOKEN_EXPIRY_BUDGET = 30
+
+# Ride out transient TikTok 429/5xx with up to 3 retries and exponential backoff.
+# urllib3 only retries idempotent methods by default: chunk PUTs are safe to
+# resend, but POSTs are not (auth codes are single-use, a repeated init would
+# start a second upload). After the last attempt, hand back the error response
+# so callers can show TikTok's body instead of raising RetryError.
+HTTP_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    raise_on_status=False,
+)
+
+# Shared HTTP session: keeps TLS connections to TikTok alive across requests
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=HTTP_RETRY,
+))
+SESSION.headers.update({"User-Agent": "tiktok-upload/1.0"})
+
+# requests' (connect, read) timeouts: urllib3 applies the first value to connecting
+# AND to sending the request body (one deadline for the whole TLS sendall), the
+# second to waiting for the response. Token/init bodies are tiny, so fail fast.
+API_TIMEOUT = (5, 30)
+
 # Maximum file size (TikTok limit is around 287MB)
 MAX_FILE_SIZE = 287 * 1024 * 1024  # 287MB in bytes
 
+# Reject oversized request bodies before Werkzeug spools them (+1MB for the other form fields)
+app.config["MAX_CONTENT_LENGTH"] = MAX_FILE_SIZE + 1024 * 1024
+
+# Videos are PUT to TikTok in Content-Range chunks of this size. TikTok accepts chunks
+# of 5-64MB; videos up to one chunk go as a single PUT and the last chunk absorbs any
+# remainder, so it can grow to just under 2x the chunk size. Capping the setting at
+# 32MB keeps that last chunk under 64MB (and any video over 64MB in several chunks).
+# Bigger chunks mean fewer PUTs but more memory per in-flight upload (up to 2x chunk).
+TIKTOK_MIN_CHUNK = 5 * 1024 * 1024
+TIKTOK_MAX_CHUNK = 64 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = min(max(int(os.getenv("UPLOAD_CHUNK_MB", "10")) * 1024 * 1024,
+                            TIKTOK_MIN_CHUNK), TIKTOK_MAX_CHUNK // 2)
+
+# A chunk PUT must finish sending within its "connect" timeout, so size that from
+# the largest chunk (last one, < 2x chunk size) at a slow-but-alive upstream rate
+MIN_UPLOAD_RATE = 256 * 1024  # bytes/second
+CHUNK_UPLOAD_TIMEOUT = (max(120, 2 * UPLOAD_CHUNK_SIZE // MIN_UPLOAD_RATE), 120)
+
+# upload_url answers 206 for intermediate chunks and 201 once the last one lands
+UPLOAD_OK_STATUSES = (200, 201, 202, 204, 206)
+
 # Upload form HTML template
 UPLOAD_FORM_HTML = """
 <!DOCTYPE html>
@@ -56,10 +196,10 @@ UPLOAD_FORM_HTML = """
 <body>
     <h2>Upload Video to TikTok</h2>
     
-    {% if not session.get('access_token') %}
+    {% if not authed %}
         <p>❌ You need to authenticate first: <a href="/login">Login with TikTok</a></p>
     {% else %}
-        <p>✅ Authenticated as: {{ session.get('open_id', 'Unknown') }}</p>
+        <p>✅ Authenticated as: {{ open_id or 'Unknown' }}</p>
         
         <form method="POST" enctype="multipart/form-data">
             <div class="form-group">
@@ -92,29 +232,214 @@ UPLOAD_FORM_HTML = """
 </html>
 """
 
+# Compile once at import; render_template_string re-parses the source on every call
+UPLOAD_FORM_TEMPLATE = app.jinja_env.from_string(UPLOAD_FORM_HTML)
+
+
+@functools.lru_cache(maxsize=256)
+def render_upload_form(authed, open_id):
+    """The upload page only varies by login state and open_id, so cache each variant"""
+    return UPLOAD_FORM_TEMPLATE.render(authed=authed, open_id=open_id)
+
+
+# Home page has no per-user content, so browsers may reuse it.
+# "private": responses can still carry the user's session Set-Cookie.
+INDEX_HTML = (
+    "<h3>TikTok OAuth + Video Upload</h3>"
+    '<p><a href="/login">Login with TikTok</a></p>'
+    '<p><a href="/upload">Upload Video</a></p>'
+    '<p><a href="/debug-auth">/debug-auth</a> (shows values the server is using)</p>'
+)
+STATIC_PAGE_HEADERS = {"Cache-Control": "private, max-age=3600"}
+
+
+# OAuth `state` values are generated in batches: one os.urandom call serves 128 logins.
+# The pool starts empty and fills on first use, so forked workers never share it.
+STATE_BYTES = 24
+STATE_POOL_SIZE = 128
+_state_pool = collections.deque()
+_state_pool_lock = threading.Lock()
+
+# Concurrent requests from one user (several tabs, retries) must not each spend the
+# same refresh_token: refreshes are serialized per refresh_token, and the outcome is
+# briefly shared with the requests that were waiting on it
+REFRESH_CACHE_SIZE = 256
+REFRESH_REUSE_WINDOW = 60  # seconds a successful refresh is handed out again
+REFRESH_FAILURE_BACKOFF = 10  # seconds before a failed refresh is retried
+_refreshed_tokens = collections.OrderedDict()  # old refresh_token -> (token_json or None, received_at)
+_refresh_locks = weakref.WeakValueDictionary()  # refresh_token -> Lock, dropped once unused
+_refresh_cache_lock = threading.Lock()  # guards the two dicts above, never held across HTTP
+
 
 # ---------- helpers ----------
 def new_state():
-    s = secrets.token_urlsafe(24)
+    with _state_pool_lock:
+        if not _state_pool:
+            raw = os.urandom(STATE_BYTES * STATE_POOL_SIZE)
+            _state_pool.extend(
+                base64.urlsafe_b64encode(raw[i:i + STATE_BYTES]).rstrip(b"=").decode()
+                for i in range(0, len(raw), STATE_BYTES)
+            )
+        s = _state_pool.popleft()
     session["oauth_state"] = s
     return s
 
 
+def is_token_response(token_json):
+    """True if a TikTok token response has everything save_tokens() needs"""
+    return "access_token" in token_json and "expires_in" in token_json
+
+
+def save_tokens(token_json, received_at=None):
+    """Store a TikTok token response (received at `received_at`, default now) in the session"""
+    received_at = received_at or time.time()
+    session.permanent = True
+    session["access_token"] = token_json["access_token"]
+    # Keep the current refresh token if TikTok didn't send a new one
+    if token_json.get("refresh_token"):
+        session["refresh_token"] = token_json["refresh_token"]
+    session["expires_at"] = int(received_at) + int(token_json["expires_in"]) - TOKEN_EXPIRY_BUDGET
+    if token_json.get("open_id"):
+        session["open_id"] = token_json["open_id"]
+    g.access_token = token_json["access_token"]
+
+
+def refresh_lock_for(refresh_token):
+    """Return the lock serializing refreshes of one refresh_token"""
+    with _refresh_cache_lock:
+        lock = _refresh_locks.get(refresh_token)
+        if lock is None:
+            lock = _refresh_locks[refresh_token] = threading.Lock()
+        return lock
+
+
+def refresh_outcome_usable(outcome, now):
+    """True while a remembered (token_json or None, received_at) may still be handed out"""
+    token_json, received_at = outcome
+    age = now - received_at
+    if token_json is None:
+        return age < REFRESH_FAILURE_BACKOFF
+    return age < min(REFRESH_REUSE_WINDOW, int(token_json["expires_in"]) - TOKEN_EXPIRY_BUDGET)
+
+
+def prune_refresh_cache(now):
+    """Forget outcomes that can no longer be reused, so old tokens don't linger in memory"""
+    stale = [rt for rt, outcome in _refreshed_tokens.items() if not refresh_outcome_usable(outcome, now)]
+    for rt in stale:
+        del _refreshed_tokens[rt]
+
+
+def recent_refresh(refresh_token):
+    """Return a still-usable remembered refresh outcome for refresh_token, or None"""
+    with _refresh_cache_lock:
+        prune_refresh_cache(time.time())
+        return _refreshed_tokens.get(refresh_token)
+
+
+def refresh_access_token(refresh_token):
+    """
+    Exchange a refresh token for a new token response.
+    
+    Returns (token_json, received_at), or (None, None) on failure. Refreshes of
+    the same refresh_token run one at a time; requests that waited on one get
+    its outcome (for REFRESH_REUSE_WINDOW, or REFRESH_FAILURE_BACKOFF after a
+    failure) instead of hitting TikTok again. Other users never wait.
+    """
+    with refresh_lock_for(refresh_token):
+        cached = recent_refresh(refresh_token)
+        if cached is None:
+            cached = (request_token_refresh(refresh_token), time.time())
+            with _refresh_cache_lock:
+                prune_refresh_cache(time.time())
+                _refreshed_tokens.pop(refresh_token, None)
+                _refreshed_tokens[refresh_token] = cached
+                if len(_refreshed_tokens) > REFRESH_CACHE_SIZE:
+                    _refreshed_tokens.popitem(last=False)
+    token_json, received_at = cached
+    if token_json is None:
+        return None, None
+    return token_json, received_at
+
+
+def request_token_refresh(refresh_token):
+    """POST grant_type=refresh_token to TikTok; returns the token JSON or None"""
+    body = (REFRESH_BODY_PREFIX + quote_plus(refresh_token)).encode()
+    try:
+        r = SESSION.post(TOKEN_URL, headers=FORM_HEADERS, data=body, timeout=API_TIMEOUT)
+        token_json = orjson.loads(r.content)
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
+        log.warning("Token refresh failed: %s", e)
+        return None
+
+    if r.status_code != 200 or not is_token_response(token_json):
+        log.warning("Token refresh failed (HTTP %s): %s", r.status_code, r.text)
+        return None
+    return token_json
+
+
+def get_access_token():
+    """
+    Return the session's access token, refreshing it shortly before it expires.
+    
+    Memoized on flask.g, so the route guard, get_auth_headers() etc. in one
+    request share a single session lookup and at most one refresh.
+    """
+    if "access_token" not in g:
+        g.access_token = load_access_token()
+    return g.access_token
+
+
+def load_access_token():
+    """Read the access token from the session, refreshing it if it is about to expire"""
+    access_token = session.get("access_token")
+    if not access_token:
+        return None
+
+    refresh_token = session.get("refresh_token")
+    expires_at = session.get("expires_at", 0)
+    now = int(time.time())  # expires_at is stored as an int, so compare ints
+    if refresh_token and expires_at - now < TOKEN_REFRESH_MARGIN:
+        token_json, received_at = refresh_access_token(refresh_token)
+        if token_json:
+            save_tokens(token_json, received_at)
+            return token_json["access_token"]
+        if now >= expires_at:
+            return None
+    return access_token
+
+
+def read_exactly(stream, size):
+    """Read `size` bytes, looping over short reads (request.stream may return less)"""
+    data = stream.read(size)
+    if len(data) == size or not data:
+        return data
+    buf = bytearray(data)
+    while len(buf) < size:
+        more = stream.read(size - len(buf))
+        if not more:
+            break
+        buf += more
+    return bytes(buf)
+
+
 def get_auth_headers():
     """Get authorization headers for API calls"""
-    access_token = session.get("access_token")
+    access_token = get_access_token()
     if not access_token:
         return None
     return {"Authorization": f"Bearer {access_token}"}
 
 
-def upload_video_to_tiktok(video_file, title="", description="", privacy_level="PUBLIC_TO_EVERYONE", 
+def upload_video_to_tiktok(video_stream, video_size, title="", description="", privacy_level="PUBLIC_TO_EVERYONE", 
                           disable_duet=False, disable_comment=False, disable_stitch=False):
     """
     Upload a video to TikTok using the inbox flow (2-step process):
     1. Initialize upload - gets upload URL
     2. Upload video content to TikTok servers
     
+    `video_stream` is read front to back exactly once, so it does not need
+    to be seekable; `video_size` is its total length in bytes.
+    
     Note: With the inbox flow, videos are uploaded to the user's TikTok inbox
     where they can manually add captions and post them through the TikTok app.
     """
@@ -123,45 +448,47 @@ def upload_video_to_tiktok(video_file, title="", description="", privacy_level="
         return {"error": "Not authenticated"}
     
     try:
-        # Get file size first
-        video_file.seek(0, 2)  # Seek to end
-        video_size = video_file.tell()
-        video_file.seek(0)  # Reset to beginning
+        if video_size <= UPLOAD_CHUNK_SIZE:
+            chunk_size, total_chunk_count = video_size, 1  # Single chunk upload
+        else:
+            chunk_size, total_chunk_count = UPLOAD_CHUNK_SIZE, video_size // UPLOAD_CHUNK_SIZE
         
         # Step 1: Initialize upload (simplified for inbox flow)
-        print("Step 1: Initializing video upload...")
+        log.info("Step 1: Initializing video upload...")
         init_data = {
             "source_info": {
                 "source": "FILE_UPLOAD",
                 "video_size": video_size,
-                "chunk_size": video_size,  # Single chunk upload
-                "total_chunk_count": 1
+                "chunk_size": chunk_size,
+                "total_chunk_count": total_chunk_count
             }
         }
         
-        headers_init = get_auth_headers()
-        headers_init["Content-Type"] = "application/json; charset=UTF-8"
+        headers_init = {**headers, **JSON_HEADERS}
         
-        print(f"Init request URL: {CONTENT_INIT_URL}")
-        print(f"Init request data: {json.dumps(init_data, indent=2)}")
-        print(f"Video size: {video_size} bytes")
+        log.info("Init request URL: %s", CONTENT_INIT_URL)
+        log.debug("Init request data: %s", init_data)
+        log.info("Video size: %s bytes", video_size)
         
-        init_response = requests.post(
+        init_response = SESSION.post(
             CONTENT_INIT_URL,
             headers=headers_init,
-            data=json.dumps(init_data),
-            timeout=30
+            data=orjson.dumps(init_data),
+            timeout=API_TIMEOUT
         )
         
-        print(f"Init response status: {init_response.status_code}")
-        print(f"Init response: {init_response.text}")
+        log.info("Init response status: %s", init_response.status_code)
+        # Response bodies (and the signed upload_url) are only logged at DEBUG;
+        # skip decoding .text at all unless that level is on
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Init response: %s", init_response.text)
         
         if init_response.status_code != 200:
             return {"error": f"Init failed (HTTP {init_response.status_code}): {init_response.text}"}
         
         try:
-            init_result = init_response.json()
-        except:
+            init_result = orjson.loads(init_response.content)
+        except orjson.JSONDecodeError:
             return {"error": f"Init response not valid JSON: {init_response.text}"}
         
         # Check for errors in response
@@ -179,36 +506,46 @@ def upload_video_to_tiktok(video_file, title="", description="", privacy_level="
         if not publish_id or not upload_url:
             return {"error": f"Init response missing publish_id or upload_url: {init_result}"}
         
-        print(f"✅ Init successful. Publish ID: {publish_id}")
-        print(f"Upload URL: {upload_url}")
+        log.info("✅ Init successful. Publish ID: %s", publish_id)
+        log.debug("Upload URL: %s", upload_url)
         
-        # Step 2: Upload video content to TikTok servers
-        print("Step 2: Uploading video content...")
-        video_file.seek(0)  # Reset file pointer
+        # Step 2: Upload video content to TikTok servers, one chunk at a time so
+        # memory stays bounded and a failed PUT only resends that chunk
+        log.info("Step 2: Uploading video content in %s chunk(s)...", total_chunk_count)
         
-        # Prepare upload headers (no Authorization needed for upload URL)
-        upload_headers = {
-            "Content-Type": "video/mp4",
-            "Content-Length": str(video_size),
-            "Content-Range": f"bytes 0-{video_size-1}/{video_size}"
-        }
-        
-        print(f"Upload headers: {upload_headers}")
-        
-        upload_response = requests.put(
-            upload_url,  # Use the full URL as provided by TikTok
-            headers=upload_headers,
-            data=video_file.read(),
-            timeout=120
-        )
-        
-        print(f"Upload response status: {upload_response.status_code}")
-        print(f"Upload response: {upload_response.text}")
-        
-        if upload_response.status_code not in [200, 201, 202, 204]:
-            return {"error": f"Upload failed (HTTP {upload_response.status_code}): {upload_response.text}"}
+        for index in range(total_chunk_count):
+            start = index * chunk_size
+            # The last chunk also carries the bytes that don't fill a whole chunk
+            end = video_size if index == total_chunk_count - 1 else start + chunk_size
+            chunk = read_exactly(video_stream, end - start)
+            if len(chunk) != end - start:
+                return {"error": f"Video stream ended early at byte {start + len(chunk)} of {video_size}"}
+            
+            # Prepare upload headers (no Authorization needed for upload URL)
+            upload_headers = {
+                "Content-Type": "video/mp4",
+                "Content-Length": str(len(chunk)),
+                "Content-Range": f"bytes {start}-{end - 1}/{video_size}"
+            }
+            
+            log.debug("Upload headers: %s", upload_headers)
+            
+            upload_response = SESSION.put(
+                upload_url,  # Use the full URL as provided by TikTok
+                headers=upload_headers,
+                data=chunk,
+                timeout=CHUNK_UPLOAD_TIMEOUT
+            )
+            
+            log.info("Upload response status: %s", upload_response.status_code)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Upload response: %s", upload_response.text)
+            
+            if upload_response.status_code not in UPLOAD_OK_STATUSES:
+                return {"error": f"Upload failed on chunk {index + 1}/{total_chunk_count} "
+                                 f"(HTTP {upload_response.status_code}): {upload_response.text}"}
         
-        print("✅ Upload successful!")
+        log.info("✅ Upload successful!")
         
         return {
             "success": True,
@@ -218,19 +555,19 @@ def upload_video_to_tiktok(video_file, title="", description="", privacy_level="
         }
         
     except Exception as e:
-        print(f"Exception during upload: {str(e)}")
+        log.exception("Exception during upload")
         return {"error": f"Exception during upload: {str(e)}"}
 
 
 # ---------- routes ----------
+@app.errorhandler(413)
+def request_too_large(e):
+    return f"❌ File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB", 413
+
+
 @app.route("/")
 def index():
-    return (
-        "<h3>TikTok OAuth + Video Upload</h3>"
-        '<p><a href="/login">Login with TikTok</a></p>'
-        '<p><a href="/upload">Upload Video</a></p>'
-        '<p><a href="/debug-auth">/debug-auth</a> (shows values the server is using)</p>'
-    )
+    return INDEX_HTML, STATIC_PAGE_HEADERS
 
 
 @app.route("/debug-auth")
@@ -244,14 +581,7 @@ def debug_auth():
         "open_id": session.get("open_id"),
     }
     # Show the exact authorize URL we will send the user to
-    params = {
-        "client_key": CLIENT_KEY,
-        "response_type": "code",
-        "scope": SCOPES,
-        "redirect_uri": REDIRECT_URI,
-        "state": session.get("oauth_state") or "(none yet)",
-    }
-    data["authorize_url"] = AUTH_URL + "?" + urlencode(params)
+    data["authorize_url"] = AUTH_URL_PREFIX + quote_plus(session.get("oauth_state") or "(none yet)")
     return jsonify(data)
 
 
@@ -259,17 +589,7 @@ def debug_auth():
 def login():
     # Always generate a fresh state to avoid reusing codes tied to older redirects
     state = new_state()
-
-    params = {
-        "client_key": CLIENT_KEY,
-        "response_type": "code",
-        "scope": SCOPES,
-        "redirect_uri": REDIRECT_URI,   # <-- EXACT SAME STRING
-        "state": state,
-        # "force_verify": "1",  # optional: forces TikTok to re-prompt
-    }
-    url = AUTH_URL + "?" + urlencode(params)
-    return redirect(url, code=302)
+    return redirect(AUTH_URL_PREFIX + quote_plus(state), code=302)
 
 
 @app.route("/callback")
@@ -285,51 +605,46 @@ def callback():
     if not code:
         return "❌ Missing ?code from TikTok.", 400
 
-    # Optional: check state
-    saved_state = session.get("oauth_state")
-    if not saved_state or saved_state != state:
+    # Optional: check state (pop: a state value is good for exactly one callback)
+    saved_state = session.pop("oauth_state", None)
+    if not saved_state or not hmac.compare_digest(saved_state.encode(), (state or "").encode()):
         return "❌ State mismatch. Start login again.", 400
 
     # --- Exchange authorization code for access token ---
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    payload = {
-        "client_key": CLIENT_KEY,
-        "client_secret": CLIENT_SECRET,
-        "code": code,
-        "grant_type": "authorization_code",
-        # *** MUST MATCH *** the value used in /login and the app portal
-        "redirect_uri": REDIRECT_URI,
-    }
-
     # Use urlencoded body (not JSON)
-    body = urlencode(payload)
-    r = requests.post(TOKEN_URL, headers=headers, data=body, timeout=30)
+    body = (TOKEN_BODY_PREFIX + quote_plus(code)).encode()
+    try:
+        r = SESSION.post(TOKEN_URL, headers=FORM_HEADERS, data=body, timeout=API_TIMEOUT)
+    except requests.Timeout:
+        return "❌ TikTok token endpoint timed out. Start login again.", 504
+    except requests.RequestException as e:
+        log.warning("Token exchange failed: %s", e)
+        return "❌ Could not reach TikTok's token endpoint. Start login again.", 502
 
     try:
-        token_json = r.json()
-    except Exception:
+        token_json = orjson.loads(r.content)
+    except orjson.JSONDecodeError:
         token_json = {"raw": r.text}
 
-    if r.status_code != 200 or "access_token" not in token_json:
+    if r.status_code != 200 or not is_token_response(token_json):
         return (
-            "❌ Token response missing access_token: "
-            + jsonify(token_json).get_data(as_text=True),
+            # Echo TikTok's body as-is rather than re-serializing the parsed dict
+            "❌ Token response missing access_token/expires_in: " + html.escape(r.text),
             400,
         )
 
     # success
-    session["access_token"] = token_json["access_token"]
-    session["open_id"] = token_json.get("open_id")
+    save_tokens(token_json)
     return redirect("/upload")
 
 
 @app.route("/upload", methods=["GET", "POST"])
 def upload():
     if request.method == "GET":
-        return render_template_string(UPLOAD_FORM_HTML, session=session)
+        return render_upload_form(bool(session.get("access_token")), session.get("open_id"))
     
     # POST request - handle file upload
-    if not session.get("access_token"):
+    if not get_access_token():
         return "❌ Not authenticated. Please login first.", 401
     
     # Get form data
@@ -354,13 +669,14 @@ def upload():
     
     # TikTok file size limit
     if file_size > MAX_FILE_SIZE:
-        return f"❌ File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB", 400
+        return f"❌ File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB", 413
     
-    print(f"Starting upload: {video_file.filename} ({file_size} bytes)")
+    log.info("Starting upload: %s (%s bytes)", video_file.filename, file_size)
     
     # Upload video
     result = upload_video_to_tiktok(
-        video_file=video_file,
+        video_stream=video_file.stream,
+        video_size=file_size,
         title=title,
         description=description
     )
@@ -385,6 +701,40 @@ def upload():
     """
 
 
+@app.route("/upload-raw", methods=["PUT", "POST"])
+def upload_raw():
+    """
+    Upload for scripts/clients: the request body IS the MP4 (no multipart form).
+    
+    Skips Werkzeug's multipart parser and temp-file spooling entirely - bytes are
+    read from request.stream and forwarded to TikTok chunk by chunk.
+    Optional metadata: X-Title / X-Description headers. Content-Length is required.
+    """
+    if not get_access_token():
+        return jsonify({"error": "Not authenticated. Please login first."}), 401
+    
+    video_size = request.content_length
+    if not video_size:
+        return jsonify({"error": "Request body must be the MP4 file, with a Content-Length header"}), 411
+    
+    # TikTok file size limit
+    if video_size > MAX_FILE_SIZE:
+        return jsonify({"error": f"File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB"}), 413
+    
+    log.info("Starting raw upload (%s bytes)", video_size)
+    
+    result = upload_video_to_tiktok(
+        video_stream=request.stream,
+        video_size=video_size,
+        title=request.headers.get("X-Title", "").strip(),
+        description=request.headers.get("X-Description", "").strip()
+    )
+    
+    if result.get("error"):
+        return jsonify(result), 400
+    return jsonify(result)
+
+
 @app.route("/logout")
 def logout():
     session.clear()
@@ -396,6 +746,23 @@ def health():
     return "ok", 200
 
 
+class HealthCheckMiddleware:
+    """Answer Render's GET /health probes before Flask (no routing, no session cookie)"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == "/health" and environ.get("REQUEST_METHOD") == "GET":
+            start_response("200 OK", [("Content-Type", "text/plain; charset=utf-8"), ("Content-Length", "2")])
+            return [b"ok"]
+        return self.wsgi_app(environ, start_response)
+
+
+# Render terminates TLS and proxies one hop; trust its X-Forwarded-For/-Proto
+app.wsgi_app = HealthCheckMiddleware(ProxyFix(app.wsgi_app, x_for=1, x_proto=1))
+
+
 if __name__ == "__main__":
-    # Local dev: python app.py
-    app.run(host="0.0.0.0", port=5051, debug=True)
\ No newline at end of file
+    # Local dev: python app.py (FLASK_DEBUG=1 for the reloader/debugger; production uses gunicorn)
+    app.run(host="0.0.0.0", port=5051, debug=os.getenv("FLASK_DEBUG") == "1")
\ No newline at end of file
@@ -0,0 +1,19 @@
+import os
+
+# Picked up automatically by `gunicorn app:app` (see render.yaml startCommand)
+
+# Uploads spend most of their time waiting on TikTok, so give each worker
+# a pool of threads instead of serving one request per process. Keep the
+# process count small: cpu_count() reports the host's cores inside a container,
+# and every in-flight upload holds up to two chunks in memory.
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# A large video PUT to TikTok can take minutes; the 30s default would kill it
+timeout = 600
+keepalive = 30
+
+# Worker heartbeats go to a tmpfs instead of a possibly slow container disk
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
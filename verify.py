@@ -1,10 +1,36 @@
+import hashlib
 import os
-from flask import Flask, send_from_directory, abort
+import re
+from flask import Flask, Response, abort, request
 
 app = Flask(__name__)
 
 CALLBACK_DIR = os.path.join(app.root_path, "callback")
 
+# Verification files only change on redeploy; let clients/CDNs cache them
+CALLBACK_MAX_AGE = 24 * 60 * 60  # seconds
+
+# Plain .txt names only (no slashes or "..") - also covers browser copies like "name (1).txt"
+SAFE_CALLBACK_NAME = re.compile(r"^[A-Za-z0-9_\- ()]{1,128}\.txt$").match
+
+
+def load_callback_files():
+    """Read every servable callback/*.txt once at startup: {filename: (body, etag, mtime)}"""
+    files = {}
+    if not os.path.isdir(CALLBACK_DIR):
+        return files
+    for entry in os.scandir(CALLBACK_DIR):
+        if entry.is_file() and SAFE_CALLBACK_NAME(entry.name):
+            with open(entry.path, "rb") as f:
+                body = f.read()
+            etag = hashlib.md5(body, usedforsecurity=False).hexdigest()
+            files[entry.name] = (body, etag, entry.stat().st_mtime)
+    return files
+
+
+# The files are tiny and immutable for the life of the process, so serve them from memory
+CALLBACK_FILES = load_callback_files()
+
 @app.route("/health")
 def health():
     return "ok", 200
@@ -19,10 +45,18 @@ def callback_index():
 # Serve verification files from /callback/<filename>
 @app.route("/callback/<path:filename>")
 def serve_callback_file(filename: str):
-    # Only allow .txt for safety
-    if not filename.endswith(".txt"):
+    # Only files loaded at startup (which passed the .txt name check) are served
+    cached = CALLBACK_FILES.get(filename)
+    if cached is None:
         abort(404)
-    return send_from_directory(CALLBACK_DIR, filename, mimetype="text/plain")
+    body, etag, mtime = cached
+    response = Response(body, mimetype="text/plain")
+    response.set_etag(etag)
+    response.last_modified = mtime
+    response.cache_control.public = True
+    response.cache_control.max_age = CALLBACK_MAX_AGE
+    # Repeat polls with If-None-Match / If-Modified-Since get an empty 304
+    return response.make_conditional(request)
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))